@@ -23,11 +23,11 @@ import os
 
 def calculate_distance_matrix(aln_path):
     # align reBLAST hits
-    aln_cmd = (
-        't_coffee {0} -no_warning -quiet -type=dna '
-        ' -output=fasta_aln -outfile={0}'.format(aln_path)
-    )
-    sp.run(aln_cmd, shell=True)
+    aln_cmd = [
+        't_coffee', aln_path, '-no_warning', '-quiet', '-type=dna',
+        '-output=fasta_aln', '-outfile={0}'.format(aln_path)
+    ]
+    sp.run(aln_cmd)
     aln = AlignIO.read(open(aln_path), 'fasta')
     calculator = DistanceCalculator('identity')
     dm = calculator.get_distance(aln)
@@ -38,23 +38,32 @@ def calculate_distance_matrix(aln_path):
     return dm
 
 
+def parse_blast_output(blast_output):
+    # parse the tabular output of a BLAST search and group the hits by query
+    hits = {}
+    for line in blast_output.splitlines():
+        data = line.split()
+        if data:
+            hits.setdefault(data[0], []).append(data)
+    return hits
+
+
 # BlastParser object performs reverse BLAST search and reports if a candidate
 # fulfills the reverse best hit criterion
 class BlastParser(object):
     # init parameters:
     # mirna: Mirna object that holds the location for the reference miRNA
-    # blastpath: path to the output file of the reverse BLAST search
+    # blasthits: hits of the reverse BLAST search for a single candidate,
+    #            as returned by parse_blast_output
     # msl: ncOrtho minimum sequence length threshold
-    def __init__(self, mirna, blastpath, msl):
+    def __init__(self, mirna, blasthits, msl):
         self.start = mirna.start
         self.end = mirna.end
         self.chromosome = mirna.chromosome
         self.strand = mirna.strand
         self.refseq = mirna.pre
         del mirna
-        #self.blastpath = blastpath
-        with open(blastpath, 'r') as blastfile:
-            self.blasthits = [line.strip().split() for line in blastfile]
+        self.blasthits = blasthits
         self.msl = msl
         #self.blasthits = []
         #self.top_score = 100
@@ -17,13 +17,56 @@ along with ncOrtho.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import glob
-import pyfaidx
 import subprocess as sp
 import sys
 import os
 
+try:
+    from ncOrtho.blastparser import parse_blast_output
+    from ncOrtho.genparser import open_genome
+    from ncOrtho.utils import PYINFERNAL
+    from ncOrtho.utils import run_blast
+    from ncOrtho.utils import search_cm
+except ImportError:
+    from blastparser import parse_blast_output
+    from genparser import open_genome
+    from utils import PYINFERNAL
+    from utils import run_blast
+    from utils import search_cm
 
-def cmsearcher(mirna, cm_cutoff, cpu, msl, models, query, blastdb, out, cleanup, heuristic):
+
+def heuristic_blast(mirnas, blastdb, cpu, evalue):
+    """
+    BLAST search of all reference pre-miRNAs in the query genome to identify
+    candidate regions for the cmsearch in heuristic mode. The pre-miRNAs are
+    searched with a single BLAST run, so that the query genome is only
+    scanned once.
+
+    Parameters
+    ----------
+    mirnas      :   Mirna objects
+    blastdb     :   Path to the BLASTdb of the query genome
+    cpu         :   Number of cores to use
+    evalue      :   Evalue cutoff of the BLAST search
+
+    Returns
+    -------
+    hits : Dictionary with a list of BLAST hits (sseqid, sstart, send, sstrand, length) for each miRNA ID
+
+    """
+    # the pre-miRNAs are passed to BLAST via stdin
+    blast_query = ''.join(">{}\n{}\n".format(mirna.name, mirna.pre) for mirna in mirnas)
+    blast_command = [
+        'blastn', '-evalue', str(evalue), '-task', 'blastn', '-db', blastdb,
+        '-num_threads', str(cpu), '-outfmt', '6 qseqid sseqid sstart send sstrand length'
+    ]
+    hits = parse_blast_output(run_blast(blast_command, blast_query))
+    print('Blast step finished')
+    # drop the qseqid column, the hits are already grouped by miRNA ID
+    return {mirid: [hit[1:] for hit in mirna_hits] for mirid, mirna_hits in hits.items()}
+
+
+def cmsearcher(mirna, cm_cutoff, cpu, msl, models, query, out, cleanup, heuristic, blast_hits=None):
     """
     Parameters
     ----------
@@ -34,10 +77,10 @@ def cmsearcher(mirna, cm_cutoff, cpu, msl, models, query, blastdb, out, cleanup,
     msl             Minimum length of CMsearch hit relative to the reference pre-miRNA length
     models      :   Path to the directory that contains the CMs
     query       :   Path to the query genome
-    qblast      :   Optional Path to a BLASTdb of the query genome
     out         :   Path to the output directory
     cleanup     :   Delete intermediate files True/False
     heuristic   :   Should heuristic mode be used and if yes, set parameters (True/False, evalue, minlength)
+    blast_hits  :   BLAST hits of the miRNA in the query genome as returned by heuristic_blast (heuristic mode only)
 
     Returns
     -------
@@ -52,37 +95,26 @@ def cmsearcher(mirna, cm_cutoff, cpu, msl, models, query, blastdb, out, cleanup,
     # Calculate the length cutoff.
     len_cut = len(mirna.pre) * msl
     blast_len_cut = len(mirna.pre) * heuristic[2]
+    model = '{}/{}.cm'.format(models, mirna_id)
     # if no model exists for mirna return False
-    if not os.path.isfile('{}/{}.cm'.format(models, mirna_id)):
+    if not os.path.isfile(model):
         print('# No model found for {}. Skipping..'.format(mirna_id))
         return False
     # Perform covariance model search.
     # Report and inclusion thresholds set according to cutoff.
 
     if heuristic[0]:
-        # extract candidate regions
-        print('# Identifying candidate regions for cmsearch heuristic')
-        tmp_out = '{0}/tmp_blast_{1}.out'.format(out, mirna_id)
-        with open(tmp_out, 'w') as inf:
-            inf.write(">{}\n{}\n".format(mirna_id, mirna.pre))
-        blast_command = (
-            'blastn -evalue {3} -task blastn -db {0} -query {1} '
-            '-num_threads {2} -outfmt "6 sseqid sstart send sstrand length"'.format(blastdb, tmp_out, cpu, heuristic[1])
-        )
-        # print(blast_command)
-        res = sp.run(blast_command, shell=True, capture_output=True)
-        os.remove(tmp_out)
-        if res.stdout:
-            print('Blast step finished')
-        else:
+        # candidate regions were identified beforehand by heuristic_blast
+        if not blast_hits:
             cm_results = False
             return cm_results
-        result = res.stdout.decode('utf-8').split('\n')
-        hit_list = [line.split() for line in result if line and float(line.split()[-1]) >= blast_len_cut]
-        # hit_list = [line.split() for line in result if line]
+        hit_list = [hit for hit in blast_hits if float(hit[-1]) >= blast_len_cut]
         print(f'# Found {len(hit_list)} BLAST hits of the reference '
               f'pre-miRNA in the query')
-        genes = pyfaidx.Fasta(query)
+        if not hit_list:
+            cm_results = False
+            return cm_results
+        genes = open_genome(query)
         # collect heuristic sequences
         print('collecting sequences')
         # set border regions to include in analysis
@@ -90,50 +122,59 @@ def cmsearcher(mirna, cm_cutoff, cpu, msl, models, query, blastdb, out, cleanup,
         diff_dict = {}
         hit_at_start = False
         hit_at_end = False
-        heuristic_fa = '{0}/heuristic_{1}.out'.format(out, mirna_id)
-        with open(heuristic_fa, 'w') as of:
-            for hit in hit_list:
-                chrom, start, end, strand, length = hit
-                strand = strand.replace('plus', '+')
-                strand = strand.replace('minus', '-')
-                if strand == '-':
-                    start, end = end, start
-                header = ">{}|{}|{}|{}\n".format(chrom, start, end, strand)
-                # print(header)
-                start = int(start)
-                end = int(end)
-                if start > extraregion:
-                    n_start = start - extraregion
-                else:
-                    # hit starts at the beginning of the chromosome
-                    n_start = 0
-                    hit_at_start = True
-                n_end = end + extraregion
-                if n_end > genes[chrom][-1].end:
-                    # hit is at the end of the chromosome
-                    n_end = genes[chrom][-1].end
-                    hit_at_end = True
-                if strand == '+':
-                    sequence = genes[chrom][n_start:n_end].seq
-                elif strand == '-':
-                    sequence = genes[chrom][n_start:n_end].reverse.complement.seq
-                header = ">{}|{}|{}|{}|{}|{}\n".format(chrom, start, end, strand, hit_at_start, hit_at_end)
-                of.write(header)
-                of.write(f'{sequence}\n')
+        regions = []
+        for hit in hit_list:
+            chrom, start, end, strand, length = hit
+            strand = strand.replace('plus', '+')
+            strand = strand.replace('minus', '-')
+            if strand == '-':
+                start, end = end, start
+            header = ">{}|{}|{}|{}\n".format(chrom, start, end, strand)
+            # print(header)
+            start = int(start)
+            end = int(end)
+            if start > extraregion:
+                n_start = start - extraregion
+            else:
+                # hit starts at the beginning of the chromosome
+                n_start = 0
+                hit_at_start = True
+            n_end = end + extraregion
+            if n_end > genes[chrom][-1].end:
+                # hit is at the end of the chromosome
+                n_end = genes[chrom][-1].end
+                hit_at_end = True
+            if strand == '+':
+                sequence = genes[chrom][n_start:n_end].seq
+            elif strand == '-':
+                sequence = genes[chrom][n_start:n_end].reverse.complement.seq
+            header = "{}|{}|{}|{}|{}|{}".format(chrom, start, end, strand, hit_at_start, hit_at_end)
+            regions.append((header, sequence))
         # start the cmsearch with the heuristic candidates
-        heuristic_cms = '{0}/cmsearch_heuristic.out'.format(out, mirna_id)
+        heuristic_cms = '{0}/cmsearch_heuristic_{1}.out'.format(out, mirna_id)
         # if not os.path.isfile(cms_output):
         print('# Running covariance model search for {}'.format(mirna_id))
-        cms_command = (
-            'cmsearch -T {5} --incT {5} --cpu {0} --noali '
-            '--tblout {1} {2}/{3}.cm {4}'
-                .format(cpu, heuristic_cms, models, mirna_id, heuristic_fa, cut_off)
-        )
-        res = sp.run(cms_command, shell=True, capture_output=True)
-        if not res.stdout:
-            print('# cmsearch did not find anything')
-            cm_results = False
-            return cm_results
+        if PYINFERNAL:
+            # search the candidate regions in-process with the cached model
+            cm_hits = search_cm(model, regions, T=cut_off, incT=cut_off)
+            with open(heuristic_cms, 'wb') as cmsfile:
+                cm_hits.write(cmsfile)
+        else:
+            heuristic_fa = '{0}/heuristic_{1}.out'.format(out, mirna_id)
+            with open(heuristic_fa, 'w') as of:
+                for header, sequence in regions:
+                    of.write('>{}\n{}\n'.format(header, sequence))
+            cms_command = [
+                'cmsearch', '-T', str(cut_off), '--incT', str(cut_off), '--cpu', str(cpu),
+                '--noali', '--tblout', heuristic_cms, model, heuristic_fa
+            ]
+            res = sp.run(cms_command, capture_output=True)
+            if cleanup:
+                os.remove(heuristic_fa)
+            if not res.stdout:
+                print('# cmsearch did not find anything')
+                cm_results = False
+                return cm_results
 
         # else:
         #     print('# Found cm_search results at: {}. Using those'.format(cms_output))
@@ -181,19 +222,17 @@ def cmsearcher(mirna, cm_cutoff, cpu, msl, models, query, blastdb, out, cleanup,
                     of.write('\n')
         cm_results = cmsearch_parser(heur_results, cut_off, len_cut, mirna_id)
         if cleanup:
-            os.remove(heuristic_fa)
             os.remove(heur_results)
             os.remove(heuristic_cms)
     else:
         cms_output = '{0}/cmsearch_{1}.out'.format(out, mirna_id)
         if not os.path.isfile(cms_output):
             print('# # Running covariance model search for {}'.format(mirna_id))
-            cms_command = (
-                'cmsearch -T {5} --incT {5} --cpu {0} --noali '
-                '--tblout {1} {2}/{3}.cm {4}'
-                    .format(cpu, cms_output, models, mirna_id, query, cut_off)
-            )
-            sp.call(cms_command, shell=True)
+            cms_command = [
+                'cmsearch', '-T', str(cut_off), '--incT', str(cut_off), '--cpu', str(cpu),
+                '--noali', '--tblout', cms_output, model, query
+            ]
+            sp.run(cms_command, check=True)
         else:
             print('# Found cm_search results at: {}. Using those'.format(cms_output))
         cm_results = cmsearch_parser(cms_output, cut_off, len_cut, mirna_id)
@@ -229,12 +268,14 @@ def cmsearch_parser(cms, cmc, lc, mirid):
 
     with open(cms) as cmsfile:
         # Collect only the hits which satisfy the bit score cutoff.
-        hits = [
-            line.strip().split() for line in cmsfile
-            if not line.startswith('#')
-               and float(line.strip().split()[14]) >= cut_off
-               and abs(int(line.split()[7]) - int(line.strip().split()[8])) >= lc
-        ]
+        # Every line is split only once and only up to the score column.
+        hits = []
+        for line in cmsfile:
+            if line.startswith('#'):
+                continue
+            hit = line.split(None, 15)
+            if float(hit[14]) >= cut_off and abs(int(hit[7]) - int(hit[8])) >= lc:
+                hits.append(hit)
         # Add the hits to the return dictionary.
         if hits:
             for candidate_nr, hit in enumerate(hits, 1):
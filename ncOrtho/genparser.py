@@ -16,8 +16,28 @@ You should have received a copy of the GNU General Public License
 along with ncOrtho.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import os
 import pyfaidx
 
+# Genomes opened by this process, keyed by process id and path
+_GENOMES = {}
+
+
+# open a genome once per process and reuse the pyfaidx index for all miRNAs
+# file handles are not shared with forked worker processes
+def open_genome(genpath):
+    key = (os.getpid(), genpath)
+    if key not in _GENOMES:
+        _GENOMES[key] = pyfaidx.Fasta(genpath)
+    return _GENOMES[key]
+
+
+# create the pyfaidx index of a genome if it does not exist yet
+# must run before worker processes open the genome, pyfaidx does not lock the index file
+def index_genome(genpath):
+    pyfaidx.Faidx(genpath).close()
+
+
 class GenomeParser(object):
     
     # genpath: path to the genome file to extract from
@@ -29,7 +49,7 @@ class GenomeParser(object):
     
     # read in the genome
     def parse_genome(self,):
-        genome = pyfaidx.Fasta(self.genpath)
+        genome = open_genome(self.genpath)
         return genome
     
     # extract the sequences for each significant hit from cmsearch
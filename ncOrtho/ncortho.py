@@ -19,8 +19,13 @@ along with ncOrtho.  If not, see <http://www.gnu.org/licenses/>.
 
 # Modules import
 import argparse
-import multiprocessing as mp
+import hashlib
+import json
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from functools import partial
 import os
+import shutil
 import subprocess as sp
 import sys
 
@@ -28,17 +33,33 @@ import sys
 try:
     from ncOrtho.blastparser import BlastParser
     from ncOrtho.blastparser import ReBlastParser
+    from ncOrtho.blastparser import parse_blast_output
     from ncOrtho.genparser import GenomeParser
+    from ncOrtho.genparser import index_genome
     from ncOrtho.cmsearch import cmsearcher
+    from ncOrtho.cmsearch import heuristic_blast
+    from ncOrtho.utils import available_cpus
     from ncOrtho.utils import check_blastdb
+    from ncOrtho.utils import load_cm
     from ncOrtho.utils import make_blastndb
+    from ncOrtho.utils import PYINFERNAL
+    from ncOrtho.utils import run_blast
+    from ncOrtho.utils import search_cm
 except ImportError:
     from blastparser import BlastParser
     from blastparser import ReBlastParser
+    from blastparser import parse_blast_output
     from genparser import GenomeParser
+    from genparser import index_genome
     from cmsearch import cmsearcher
+    from cmsearch import heuristic_blast
+    from utils import available_cpus
     from utils import check_blastdb
+    from utils import load_cm
     from utils import make_blastndb
+    from utils import PYINFERNAL
+    from utils import run_blast
+    from utils import search_cm
 
 ###############################################################################
 
@@ -68,7 +89,194 @@ class Mirna(object):
         self.bit = bit
 
 
-def mirna_maker(mirpath, cmpath, output, msl):
+def cm_self_score(model, mirid, seq):
+    """
+    Searches a sequence against a covariance model with the Infernal
+    bindings and returns the bit score of the best hit.
+
+    Parameters
+    ----------
+    model : STR
+        Path to the covariance model.
+    mirid : STR
+        miRNA identifier.
+    seq : STR
+        Nucleotide sequence of the pre-miRNA.
+
+    Returns
+    -------
+    FLOAT or None
+        Bit score of the best hit or None if no hit was found.
+
+    """
+    hits = search_cm(model, [(mirid, seq)], E=0.01)
+    if hits:
+        return hits[0].score
+    return None
+
+
+def cm_name(model):
+    """
+    Returns the name of a covariance model as reported by cmsearch.
+
+    Parameters
+    ----------
+    model : STR
+        Path to the covariance model.
+
+    Returns
+    -------
+    STR
+        Name of the model.
+
+    """
+    with open(model) as cmfile:
+        for line in cmfile:
+            if line.startswith('NAME'):
+                return line.split()[1]
+
+
+def cmsearch_self_scores(sequences, models, output, batch_size=50):
+    """
+    Calculates the reference bit scores of all miRNAs with cmsearch. The
+    pre-miRNAs are written to one FASTA file per batch and searched with the
+    concatenation of the covariance models of the batch.
+
+    Every model is searched against every pre-miRNA of its batch, of which
+    only the search against its own sequence is kept. The batch size limits
+    this quadratic number of searches. E-values are calculated with a search
+    space of the smallest pre-miRNA of the batch and rescaled to the length
+    of each pre-miRNA, so that the scores are the same as those of
+    cm_self_score.
+
+    Parameters
+    ----------
+    sequences : DICT
+        Pre-miRNA sequences, keyed by miRNA ID.
+    models : DICT
+        Paths to the covariance models, keyed by miRNA ID.
+    output : STR
+        Path for writing temporary files.
+    batch_size : INT, optional
+        Number of miRNAs searched with one cmsearch run.
+
+    Returns
+    -------
+    scores : DICT
+        Bit score of each miRNA against its own model, keyed by miRNA ID.
+        miRNAs without a hit are missing.
+
+    """
+    query = '{0}/all_refs.fa'.format(output)
+    combined_cm = '{0}/all_refs.cm'.format(output)
+    cms_output = '{0}/all_refs.tbl'.format(output)
+    cms_log = '{0}/all_refs.log'.format(output)
+
+    scores = {}
+    mirids = list(sequences)
+    for i in range(0, len(mirids), batch_size):
+        batch = mirids[i:i + batch_size]
+        with open(query, 'w') as tmpfile:
+            for mirid in batch:
+                tmpfile.write('>{0}\n{1}\n'.format(mirid, sequences[mirid]))
+        # names of the models in the cmsearch output
+        model_names = {}
+        with open(combined_cm, 'w') as cmfile:
+            for mirid in batch:
+                model_names[mirid] = cm_name(models[mirid])
+                with open(models[mirid]) as inf:
+                    shutil.copyfileobj(inf, cmfile)
+
+        # search space of both strands of a single pre-miRNA, as in
+        # cm_self_score, given in Mb
+        db_sizes = {mirid: 2 * len(sequences[mirid]) for mirid in batch}
+        min_size = min(db_sizes.values())
+        cms_command = [
+            'cmsearch', '-E', '0.01', '-Z', str(min_size / 1e6), '--noali',
+            '-o', cms_log, '--tblout', cms_output, combined_cm, query
+        ]
+        sp.run(cms_command, check=True)
+
+        with open(cms_output) as cmsfile:
+            for line in cmsfile:
+                if line.startswith('#'):
+                    continue
+                # stop splitting after the E-value column
+                data = line.split(None, 16)
+                target, model_name = data[0], data[2]
+                # Only the search of each miRNA against its own model is of
+                # interest. Hits are sorted by score, the first one is the best.
+                if target in scores or model_names.get(target) != model_name:
+                    continue
+                evalue = float(data[15]) * db_sizes[target] / min_size
+                if evalue <= 0.01:
+                    scores[target] = float(data[14])
+
+    # Remove temporary files.
+    for rmv_file in (cms_output, cms_log, query, combined_cm):
+        try:
+            os.remove(rmv_file)
+        except FileNotFoundError:
+            pass
+
+    return scores
+
+
+def read_bitscore_table(path):
+    """
+    Reads precomputed reference bit scores from a tab separated file with
+    the miRNA ID in the first and the bit score in the second column.
+
+    Parameters
+    ----------
+    path : STR
+        Path to the bit score table.
+
+    Returns
+    -------
+    scores : DICT
+        Reference bit scores, keyed by miRNA ID.
+
+    """
+    scores = {}
+    with open(path) as table:
+        for line_nr, line in enumerate(table, 1):
+            if line.startswith('#') or not line.strip():
+                continue
+            try:
+                mirid, score = line.split()[:2]
+                scores[mirid] = float(score)
+            except ValueError:
+                print(
+                    'ERROR: Line {} of {} is not a miRNA ID followed by a bit score: {}'
+                    .format(line_nr, path, line.strip())
+                )
+                sys.exit(1)
+    return scores
+
+
+def write_bitscore_table(path, scores):
+    """
+    Writes reference bit scores in the format read by read_bitscore_table.
+
+    Parameters
+    ----------
+    path : STR
+        Path to the bit score table.
+    scores : DICT
+        Reference bit scores, keyed by miRNA ID. miRNAs without a score
+        (None) are left out.
+
+    """
+    with open(path, 'w') as table:
+        table.write('# miRNA\tbit_score\n')
+        table.writelines(
+            '{}\t{}\n'.format(mirid, score) for mirid, score in scores.items()
+            if score is not None
+        )
+
+
+def mirna_maker(mirpath, cmpath, output, msl, known_scores=None, fixed_score=None):
     """
     Parses the miRNA data input file and returns a dictionary of Mirna objects.
 
@@ -82,6 +290,11 @@ def mirna_maker(mirpath, cmpath, output, msl):
         Path for writing temporary files.
     msl : FLOAT
         Length filter.
+    known_scores : DICT, optional
+        Precomputed reference bit scores, keyed by miRNA ID. No search is
+        performed for these miRNAs.
+    fixed_score : FLOAT, optional
+        Reference bit score to use for all miRNAs. No search is performed.
 
     Returns
     -------
@@ -98,70 +311,311 @@ def mirna_maker(mirpath, cmpath, output, msl):
             if not line.startswith('#')
         ]
 
+    # Check if the covariance model even exists, otherwise skip to
+    # the next miRNA.
+    models = {}
     for mirna in mirna_data:
         mirid = mirna[0]
-        seq = mirna[5]
-        query = '{0}/{1}.fa'.format(output, mirid)
         model = '{0}/{1}.cm'.format(cmpath, mirid)
-        # Check if the covariance model even exists, otherwise skip to
-        # the next miRNA.
         if not os.path.isfile(model):
             print('# No covariance model found for {}'.format(mirid))
             continue
-        # Check if the output folder exists, otherwise create it.
-        if not os.path.isdir('{}'.format(output)):
-            mkdir = 'mkdir -p {}'.format(output)
-            sp.call(mkdir, shell=True)
-
-
-        # Obtain the reference bit score for each miRNA by applying it
-        # to its own covariance model.
-        print('# Calculating reference bit score for {}.'.format(mirid))
-        
-        # Create a temporary FASTA file with the miRNA sequence as
-        # query for external search tool cmsearch to calculate the
-        # reference bit score.
-        with open(query, 'w') as tmpfile:
-            tmpfile.write('>{0}\n{1}'.format(mirid, seq))
-        cms_output = '{0}/ref_cmsearch_{1}_tmp.out'.format(output, mirid)
-        cms_log = '{0}/ref_cmsearch_{1}.log'.format(output, mirid)
-        if not os.path.isfile(cms_output):
-            cms_command = (
-                'cmsearch -E 0.01 --noali -o {3} --tblout {0} {1} {2}'
-                .format(cms_output, model, query, cms_log)
+        models[mirid] = model
+    mirna_data = [mirna for mirna in mirna_data if mirna[0] in models]
+    if not mirna_data:
+        return mmdict
+    # Create the output folder if it does not exist.
+    os.makedirs(output, exist_ok=True)
+
+    # Reuse reference bit scores of earlier runs. They are keyed by the
+    # miRNA ID and the contents of the sequence and the model, not by any
+    # path or modification time.
+    cache_path = '{}/.bitscore_cache.json'.format(output)
+    if os.path.isfile(cache_path):
+        with open(cache_path) as cache_file:
+            cache = json.load(cache_file)
+    else:
+        cache = {}
+    keys = {}
+    for mirna in mirna_data:
+        with open(models[mirna[0]], 'rb') as cmfile:
+            model_hash = hashlib.sha1(cmfile.read()).hexdigest()
+        keys[mirna[0]] = '{}:{}:{}'.format(
+            mirna[0], hashlib.sha1(mirna[5].encode()).hexdigest(), model_hash
+        )
+    # Reference bit scores given by the user replace the search entirely.
+    if fixed_score is not None:
+        ref_scores = {mirid: fixed_score for mirid in models}
+    else:
+        ref_scores = {
+            mirid: score for mirid, score in (known_scores or {}).items() if mirid in models
+        }
+    for mirid, key in keys.items():
+        if mirid not in ref_scores and key in cache:
+            print('# Found reference bit score for {} at: {} using it'.format(mirid, cache_path))
+            ref_scores[mirid] = cache[key]
+    missing = [mirna for mirna in mirna_data if mirna[0] not in ref_scores]
+
+    # Obtain the reference bit score for each miRNA by applying it
+    # to its own covariance model.
+    if PYINFERNAL:
+        for mirna in missing:
+            mirid = mirna[0]
+            print('# Calculating reference bit score for {}.'.format(mirid))
+            ref_scores[mirid] = cm_self_score(models[mirid], mirid, mirna[5])
+    elif missing:
+        print('# Calculating reference bit scores.')
+        sequences = {mirna[0]: mirna[5] for mirna in missing}
+        ref_scores.update(cmsearch_self_scores(sequences, models, output))
+
+    if missing:
+        for mirna in missing:
+            cache[keys[mirna[0]]] = ref_scores.get(mirna[0])
+        with open(cache_path, 'w') as cache_file:
+            json.dump(cache, cache_file)
+    # Store the reference bit scores for --bitscore_table.
+    if fixed_score is None:
+        write_bitscore_table(
+            '{}/bitscores.tsv'.format(output),
+            {mirna[0]: ref_scores.get(mirna[0]) for mirna in mirna_data}
+        )
+
+    for mirna in mirna_data:
+        top_score = ref_scores.get(mirna[0])
+        # In case of any issues occuring in the calculation of the bit
+        # score, no specific threshold can be determined. The value will
+        # set to zero, which technically turns off the filter.
+        if top_score is None:
+            print(
+                '# Warning: Self bit score for {} not applicable, '
+                'setting threshold to 0.'.format(mirna[0])
             )
-            sp.call(cms_command, shell=True)
-        else:
-            print('# Found cmsearch results at: {} using those'.format(cms_output))
-        with open(cms_output) as cmsfile:
-            hits = [
-                line.strip().split() for line in cmsfile
-                if not line.startswith('#')
-            ]
-            if hits:
-                top_score = float(hits[0][14])
-            # In case of any issues occuring in the calculation of the bit
-            # score, no specific threshold can be determined. The value will
-            # set to zero, which technically turns off the filter.
-            else:
-                print(
-                    '# Warning: Self bit score not applicable, '
-                    'setting threshold to 0.'
-                )
-                top_score = 0.0
+            top_score = 0.0
 
         mirna.append(top_score)
 
-        # Remove temporary files.
-        for rmv_file in [cms_output, cms_log, query]:
-            sp.call('rm {}'.format(rmv_file), shell=True)
-
         # Create output.
         mmdict[mirna[0]] = Mirna(*mirna)
 
     return mmdict
 
 
+@dataclass(frozen=True)
+class SearchConfig:
+    """Settings shared by all ortholog searches of an ncOrtho run."""
+    models: str
+    output: str
+    qname: str
+    qlink: str
+    refblast: str
+    cpu: int
+    cm_cutoff: float
+    msl: float
+    heuristic: tuple
+    max_hits: int
+    dust: str
+    reblast_word_size: int
+    reblast_evalue: float
+    checkCoorthref: bool
+    cleanup: bool
+
+
+def _search_candidates(mirna, blast_hits, cfg):
+    """
+    Searches ortholog candidates of a single miRNA with its covariance
+    model. Runs in a worker process.
+
+    Parameters
+    ----------
+    mirna : Mirna
+        Reference miRNA.
+    blast_hits : LIST
+        BLAST hits of the miRNA in the query genome (heuristic mode only).
+    cfg : SearchConfig
+        Settings of the ncOrtho run.
+
+    Returns
+    -------
+    cm_results : DICT
+        Accepted cmsearch hits, keyed by candidate ID.
+    candidates : DICT
+        Sequences of the candidates, keyed by candidate ID.
+
+    """
+    mirna_id = mirna.name
+
+    # Create output folder, if not existent.
+    if cfg.heuristic:
+        outdir = '{}'.format(cfg.output)
+    else:
+        outdir = '{}/{}'.format(cfg.output, mirna_id)
+    os.makedirs(outdir, exist_ok=True)
+
+    # start cmsearch
+    cm_results = cmsearcher(
+        mirna, cfg.cm_cutoff, cfg.cpu, cfg.msl, cfg.models, cfg.qlink,
+        cfg.output, cfg.cleanup, cfg.heuristic, blast_hits
+    )
+
+    # Extract sequences for candidate hits (if any were found).
+    if not cm_results:
+        print('# No hits found for {}.\n'.format(mirna_id))
+        sys.stdout.flush()
+        return {}, {}
+    elif cfg.max_hits and len(cm_results) > cfg.max_hits:
+        print('# Maximum CMsearch hits reached. Restricting to best {} hits'.format(cfg.max_hits))
+        cm_results = {k: cm_results[k] for k in list(cm_results.keys())[:cfg.max_hits]}
+    # get sequences for each CM result
+    gp = GenomeParser(cfg.qlink, cm_results.values())
+    candidates = gp.extract_sequences()
+    nr_candidates = len(candidates)
+    if nr_candidates == 1:
+        print(
+            '\n# Covariance model search successful, found 1 '
+            'ortholog candidate for {}.\n'.format(mirna_id)
+        )
+    else:
+        print(
+            '\n# Covariance model search successful, found {} '
+            'ortholog candidates for {}.\n'
+            .format(nr_candidates, mirna_id)
+        )
+    sys.stdout.flush()
+    return cm_results, candidates
+
+
+def reverse_blast(candidates, cfg, cpu):
+    """
+    Searches the ortholog candidates in the reference genome. The
+    candidates of all miRNAs are searched with a single BLAST run, so that
+    the reference BLASTdb is only loaded once. BLAST reads the candidates
+    from stdin and writes the hits to stdout.
+
+    Parameters
+    ----------
+    candidates : DICT
+        Sequences of the candidates, keyed by candidate ID.
+    cfg : SearchConfig
+        Settings of the ncOrtho run.
+    cpu : INT
+        Number of CPU cores to use.
+
+    Returns
+    -------
+    DICT
+        BLAST hits of each candidate, keyed by candidate ID.
+
+    """
+    reblast_query = ''.join(
+        '>{0}\n{1}\n'.format(candidate, candidates[candidate]) for candidate in candidates
+    )
+    blast_command = [
+        'blastn', '-task', 'blastn', '-db', cfg.refblast,
+        '-word_size', str(cfg.reblast_word_size), '-evalue', str(cfg.reblast_evalue),
+        '-max_target_seqs', '5', '-dust', cfg.dust,
+        '-num_threads', str(cpu), '-outfmt',
+        '6 qseqid sseqid pident length mismatch gapopen qstart qend sstart send evalue bitscore sseq'
+    ]
+    return parse_blast_output(run_blast(blast_command, reblast_query))
+
+
+def _verify_candidates(mirna, search, blast_hits, cfg):
+    """
+    Verifies the ortholog candidates of a single miRNA with the reverse
+    BLAST hits and writes the accepted orthologs. Runs in a worker process.
+
+    Parameters
+    ----------
+    mirna : Mirna
+        Reference miRNA.
+    search : TUPLE
+        cmsearch hits and candidate sequences as returned by _search_candidates.
+    blast_hits : DICT
+        Reverse BLAST hits, keyed by candidate ID.
+    cfg : SearchConfig
+        Settings of the ncOrtho run.
+
+    Returns
+    -------
+    written : DICT
+        Path of the ortholog FASTA file, keyed by miRNA ID. Empty if no
+        ortholog was found.
+
+    """
+    written = {}
+    mirna_id = mirna.name
+    cm_results, candidates = search
+    if not candidates:
+        return written
+    if cfg.heuristic:
+        outdir = '{}'.format(cfg.output)
+    else:
+        outdir = '{}/{}'.format(cfg.output, mirna_id)
+    print('# Evaluating candidates of {}.\n'.format(mirna_id))
+
+    # Evaluate the reverse BLAST hits to verify candidates, stored in
+    # a list (accepted_hits).
+    reblast_hits = {}
+    for candidate in candidates:
+        sequence = candidates[candidate]
+        print('# Evaluating reverse blast hits of {}'.format(candidate))
+        bp = BlastParser(mirna, blast_hits.get(candidate, []), cfg.msl)
+        # the parse_blast_output function will return True if the candidate is accepted
+        if bp.evaluate_besthit():
+            print('Found best hit')
+            reblast_hits[candidate] = sequence
+        elif cfg.checkCoorthref:
+            print('Best hit differs from reference sequence! Doing further checks\n')
+            # coorth_out = '{0}/{1}_coorth'.format(outdir, candidate)
+            if bp.check_coortholog_ref(sequence, outdir):
+                reblast_hits[candidate] = sequence
+        else:
+            print('Best hit does not overlap with miRNA location')
+
+    # Write output file if at least one candidate got accepted.
+    if reblast_hits:
+        nr_accepted = len(reblast_hits)
+        if nr_accepted == 1:
+            print('# ncOrtho found 1 verified ortholog.\n')
+            out_dict = reblast_hits
+        else:
+            print(
+                '# ncOrtho found {} potential co-orthologs.\n'
+                .format(nr_accepted)
+            )
+            print('# Evaluating distance between candidates to verify co-orthologs')
+            rbp = ReBlastParser(mirna, reblast_hits)
+            out_dict = rbp.verify_coorthologs(outdir)
+            if len(out_dict) == 1:
+                print('ncOrtho found 1 verified ortholog')
+            else:
+                print(
+                    '# ncOrtho found {} verified co-orthologs.\n'
+                        .format(len(out_dict))
+                )
+
+        print('# Writing output of accepted candidates.\n')
+        outpath = '{0}/{1}_orthologs.fa'.format(outdir, mirna_id)
+        written[mirna_id] = outpath
+        with open(outpath, 'w') as of:
+            # header: query name followed by the cmsearch hit data
+            of.writelines(
+                '>{0}\n{1}\n'.format('|'.join([cfg.qname, *map(str, cm_results[hit])]), out_dict[hit])
+                for hit in out_dict
+            )
+
+        # write_output(out_dict, outpath, cm_results)
+        print('# Finished writing output.\n')
+    else:
+        print(
+            '# None of the candidates for {} could be verified.\n'
+            .format(mirna_id)
+        )
+    print('# Finished ortholog search for {}.'.format(mirna_id))
+    sys.stdout.flush()
+    return written
+
+
 # Allow boolean argument parsing
 def str2bool(v):
     if isinstance(v, bool):
@@ -232,7 +686,7 @@ def main():
     optional.add_argument(
         '--cpu', metavar='int', type=int,
         help='Number of CPU cores to use (Default: all available)', nargs='?',
-        const=mp.cpu_count(), default=mp.cpu_count()
+        const=None, default=None
     )
     # bit score cutoff for cmsearch hits
     optional.add_argument(
@@ -240,6 +694,19 @@ def main():
         help='CMsearch bit score cutoff, given as ratio of the CMsearch bitscore '
              'of the CM against the refernce species (Default: 0.5)', nargs='?', const=0.5, default=0.5
     )
+    # absolute bit score cutoff for cmsearch hits
+    optional.add_argument(
+        '--abs_cm_cutoff', metavar='float', type=float, nargs='?', const=None, default=None,
+        help='Absolute CMsearch bit score cutoff. Replaces --cm_cutoff and skips the calculation '
+             'of the reference bit scores (Default: off)'
+    )
+    # precomputed reference bit scores
+    optional.add_argument(
+        '--bitscore_table', metavar='<path>', type=str, nargs='?', const='', default='',
+        help='Tab separated file with miRNA IDs and their reference bit scores, '
+             'e.g. bitscores.tsv in the output directory of an earlier run. '
+             'The reference bit score is only calculated for miRNAs missing in this file'
+    )
     # length filter to prevent short hits
     optional.add_argument(
         '--minlength', metavar='float', type=float,
@@ -305,6 +772,19 @@ def main():
         nargs='?',
         const='no', default='no'
     )
+    # seed length of the re-BLAST
+    optional.add_argument(
+        '--reblast_word_size', metavar='int', type=int, nargs='?', const=20, default=20,
+        help=(
+            'Word size of the BLASTn search of the candidates in the reference genome (re-BLAST). '
+            'Larger values speed up the search, but may miss divergent sequences (Default: 20)'
+        )
+    )
+    # evalue cutoff of the re-BLAST
+    optional.add_argument(
+        '--reblast_evalue', metavar='float', type=float, nargs='?', const=1e-6, default=1e-6,
+        help='Evalue cutoff for the BLASTn search of the candidates in the reference genome (Default: 1e-6)'
+    )
     # check Co-ortholog-ref
     parser.add_argument(
         '--checkCoorthologsRef', type=str2bool, metavar='True/False', nargs='?', const=False, default=False,
@@ -327,8 +807,10 @@ def main():
         args = parser.parse_args()
     
     # Check if computer provides the desired number of cores.
-    available_cpu = mp.cpu_count()
-    if args.cpu > available_cpu:
+    available_cpu = available_cpus()
+    if not args.cpu:
+        cpu = available_cpu
+    elif args.cpu > available_cpu:
         print(
             '# Error: The provided number of CPU cores is higher than the '
             'number available on this system. Exiting...'
@@ -353,6 +835,8 @@ def main():
     refblast = args.refblast
     qblast = args.queryblast
     dust = args.dust.strip()
+    reblast_word_size = args.reblast_word_size
+    reblast_evalue = args.reblast_evalue
 
     ##########################################################################################
     # Starting argument checks
@@ -367,8 +851,15 @@ def main():
     if not output.split('/')[-1] == qname:
         output = f'{output}/{qname}'
 
+    # --abs_cm_cutoff does not use reference bit scores at all
+    if args.abs_cm_cutoff is not None and args.bitscore_table:
+        print('ERROR: --abs_cm_cutoff and --bitscore_table cannot be combined')
+        sys.exit()
+
     # Test if input files exist
     all_files = [mirnas, reference, query]
+    if args.bitscore_table:
+        all_files.append(args.bitscore_table)
     for pth in all_files:
         if not os.path.isfile(pth):
             print(f'ERROR: {pth} is not a file')
@@ -379,13 +870,14 @@ def main():
 
     # create symbolic links to guarantee writing permissions
     q_data = '{}/data'.format(output)
-    if not os.path.isdir(q_data):
-        os.makedirs(q_data)
+    os.makedirs(q_data, exist_ok=True)
     qlink = f'{q_data}/{qname}.fa'
     try:
         os.symlink(query, qlink)
     except FileExistsError:
         pass
+    # Index the query genome before the worker processes read from it.
+    index_genome(qlink)
 
     # check if reference BLASTdb was given as input
     if refblast:
@@ -420,125 +912,64 @@ def main():
     print('### Starting ncOrtho run for {}'.format(query))
 
     # Create miRNA objects from the list of input miRNAs.
-    mirna_dict = mirna_maker(mirnas, models, output, msl)
-
-    # Identify ortholog candidates.
-    for mir_data in mirna_dict:
-        sys.stdout.flush()
-        mirna = mirna_dict[mir_data]
-        mirna_id = mirna.name
-
-        # Create output folder, if not existent.
-        if heuristic:
-            outdir = '{}'.format(output)
-        else:
-            outdir = '{}/{}'.format(output, mirna_id)
-        if not os.path.isdir(outdir):
-            os.makedirs(outdir)
-
-        # start cmsearch
-        cm_results = cmsearcher(mirna, cm_cutoff, cpu, msl, models, qlink, qblast, output, cleanup, heuristic)
-
-        # Extract sequences for candidate hits (if any were found).
-        if not cm_results:
-            print('# No hits found for {}.\n'.format(mirna_id))
-            continue
-        elif max_hits and len(cm_results) > max_hits:
-            print('# Maximum CMsearch hits reached. Restricting to best {} hits'.format(max_hits))
-            cm_results = {k: cm_results[k] for k in list(cm_results.keys())[:max_hits]}
-        # get sequences for each CM result
-        gp = GenomeParser(qlink, cm_results.values())
-        candidates = gp.extract_sequences()
-        nr_candidates = len(candidates)
-        if nr_candidates == 1:
-            print(
-                '\n# Covariance model search successful, found 1 '
-                'ortholog candidate.\n'
-            )
-        else:
-            print(
-                '\n# Covariance model search successful, found {} '
-                'ortholog candidates.\n'
-                .format(nr_candidates)
-            )
-        print('# Evaluating candidates.\n')
-        
-        # Perform reverse BLAST test to verify candidates, stored in
-        # a list (accepted_hits).
-        reblast_hits = {}
-        for candidate in candidates:
-            sequence = candidates[candidate]
-            temp_fasta = '{0}/{1}.fa'.format(outdir, candidate)
-            with open(temp_fasta, 'w') as tempfile:
-                tempfile.write('>{0}\n{1}\n'.format(candidate, sequence))
-            blast_output = '{0}/blast_{1}.out'.format(outdir, candidate)
-            print('# Starting reverse blast for {}'.format(candidate))
-            # blast_search will write results to the temp_fasta file
-            blast_command = (
-                'blastn -task blastn -db {0} -query {1} -max_target_seqs 10 -dust {4} '
-                '-out {2} -num_threads {3} -outfmt "6 qseqid sseqid pident '
-                'length mismatch gapopen qstart qend sstart send evalue bitscore sseq"'
-                    .format(refblast, temp_fasta, blast_output, cpu, dust)
-            )
-            sp.run(blast_command, shell=True)
+    if args.abs_cm_cutoff is not None:
+        # cmsearcher multiplies the reference bit score with cm_cutoff
+        cm_cutoff = 1.0
+        fixed_score = args.abs_cm_cutoff
+    else:
+        fixed_score = None
+    known_scores = read_bitscore_table(args.bitscore_table) if args.bitscore_table else None
+    mirna_dict = mirna_maker(mirnas, models, output, msl, known_scores, fixed_score)
+
+    # Collect candidate regions for the cmsearch of all miRNAs at once.
+    if heuristic[0] and mirna_dict:
+        print('# Identifying candidate regions for cmsearch heuristic')
+        regions = heuristic_blast(mirna_dict.values(), qblast, cpu, heuristic[1])
+    else:
+        regions = {}
+    # Parse the models of the in-process cmsearch before the worker
+    # processes are forked, so that they inherit them. Models are not
+    # loaded yet if the bit scores came from the cache or the user.
+    if PYINFERNAL:
+        for mirid in regions:
+            if mirid in mirna_dict:
+                load_cm('{}/{}.cm'.format(models, mirid))
+
+    # Identify ortholog candidates. The miRNAs are searched in parallel,
+    # the available cores are split among the worker processes.
+    workers = max(1, min(cpu, len(mirna_dict)))
+    cfg = SearchConfig(
+        models=models, output=output, qname=qname, qlink=qlink,
+        refblast=refblast, cpu=max(1, cpu // workers), cm_cutoff=cm_cutoff,
+        msl=msl, heuristic=heuristic, max_hits=max_hits, dust=dust,
+        reblast_word_size=reblast_word_size, reblast_evalue=reblast_evalue,
+        checkCoorthref=checkCoorthref, cleanup=cleanup
+    )
+    mirnas = list(mirna_dict.values())
+    sys.stdout.flush()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        searches = list(executor.map(
+            partial(_search_candidates, cfg=cfg), mirnas,
+            [regions.get(mirna.name) for mirna in mirnas]
+        ))
+
+        # Perform reverse BLAST test of the candidates of all miRNAs.
+        all_candidates = {}
+        for cm_results, candidates in searches:
+            all_candidates.update(candidates)
+        if all_candidates:
+            print('# Starting reverse blast for {} candidates'.format(len(all_candidates)))
+            blast_hits = reverse_blast(all_candidates, cfg, cpu)
             print('# finished blast')
-
-            # BlastParser will read the temp_fasta file
-            bp = BlastParser(mirna, blast_output, msl)
-            # the parse_blast_output function will return True if the candidate is accepted
-            if bp.evaluate_besthit():
-                print('Found best hit')
-                reblast_hits[candidate] = sequence
-            elif checkCoorthref:
-                print('Best hit differs from reference sequence! Doing further checks\n')
-                # coorth_out = '{0}/{1}_coorth'.format(outdir, candidate)
-                if bp.check_coortholog_ref(sequence, outdir):
-                    reblast_hits[candidate] = sequence
-            else:
-                print('Best hit does not overlap with miRNA location')
-            if cleanup:
-                os.remove(temp_fasta)
-                os.remove(blast_output)
-
-        # Write output file if at least one candidate got accepted.
-        if reblast_hits:
-            nr_accepted = len(reblast_hits)
-            if nr_accepted == 1:
-                print('# ncOrtho found 1 verified ortholog.\n')
-                out_dict = reblast_hits
-            else:
-                print(
-                    '# ncOrtho found {} potential co-orthologs.\n'
-                    .format(nr_accepted)
-                )
-                print('# Evaluating distance between candidates to verify co-orthologs')
-                rbp = ReBlastParser(mirna, reblast_hits)
-                out_dict = rbp.verify_coorthologs(outdir)
-                if len(out_dict) == 1:
-                    print('ncOrtho found 1 verified ortholog')
-                else:
-                    print(
-                        '# ncOrtho found {} verified co-orthologs.\n'
-                            .format(len(out_dict))
-                    )
-
-            print('# Writing output of accepted candidates.\n')
-            outpath = '{0}/{1}_orthologs.fa'.format(outdir, mirna_id)
-            with open(outpath, 'w') as of:
-                for hit in out_dict:
-                    cmres = list(cm_results[hit])
-                    cmres.insert(qname)
-                    header = '|'.join(cmres)
-                    of.write('>{0}\n{1}\n'.format(header, out_dict[hit]))
-
-            # write_output(out_dict, outpath, cm_results)
-            print('# Finished writing output.\n')
         else:
-            print(
-                '# None of the candidates for {} could be verified.\n'
-                .format(mirna_id)
-            )
-        print('# Finished ortholog search for {}.'.format(mirna_id))
+            blast_hits = {}
+
+        for written in executor.map(
+                partial(_verify_candidates, cfg=cfg), mirnas, searches,
+                [{c: blast_hits.get(c, []) for c in candidates} for cm_results, candidates in searches]
+        ):
+            for mirna_id, outpath in written.items():
+                print('# Orthologs of {} written to: {}'.format(mirna_id, outpath))
     print('### ncOrtho is finished!')
 
 
@@ -1,16 +1,78 @@
-import glob
+import os
 import subprocess as sp
+import sys
+
+# Optional in-process Infernal bindings. Fall back to the cmsearch
+# executable if they are not installed.
+try:
+    from pyhmmer.easel import DigitalSequenceBlock
+    from pyhmmer.easel import TextSequence
+    from pyinfernal.cm import CMFile
+    from pyinfernal.cm import Pipeline
+    PYINFERNAL = True
+except ImportError:
+    PYINFERNAL = False
+
+# Covariance models that were already parsed by this process, keyed by path.
+# main() fills it before the worker pool is created. With the fork start
+# method the workers inherit the parsed models, otherwise (spawn, forkserver)
+# every worker parses the models it needs itself.
+_CM_CACHE = {}
+
+
+def load_cm(model):
+    if model not in _CM_CACHE:
+        with CMFile(model) as cm_file:
+            _CM_CACHE[model] = cm_file.read()
+    return _CM_CACHE[model]
+
+
+def search_cm(model, sequences, **options):
+    # search (name, sequence) pairs with a covariance model in-process
+    # options are passed on to the Infernal pipeline (e.g. E, T, incT)
+    cm = load_cm(model)
+    targets = DigitalSequenceBlock(
+        cm.alphabet,
+        [TextSequence(name=name, sequence=seq).digitize(cm.alphabet) for name, seq in sequences]
+    )
+    # database size of both strands, as used by cmsearch
+    db_size = 2 * sum(len(seq) for name, seq in sequences)
+    pipeline = Pipeline(cm.alphabet, Z=db_size, **options)
+    return pipeline.search_cm(cm, targets)
+
+
+def run_blast(blast_command, blast_query):
+    # run BLAST with the query on stdin and return its tabular output from stdout
+    res = sp.run(blast_command, input=blast_query, text=True, capture_output=True)
+    if res.returncode != 0:
+        # stderr is captured, show BLAST's error message before failing
+        print('# Error: BLAST search failed:\n{}'.format(res.stderr), file=sys.stderr)
+        res.check_returncode()
+    return res.stdout
+
+
+def available_cpus():
+    # cores this process may run on, respects taskset and cgroup cpusets (e.g. SLURM, Docker)
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
 
 
 def check_blastdb(db_path):
-    file_extensions = ['nhr', 'nin', 'nsq']
-    for fe in file_extensions:
-        files = glob.glob(f'{db_path}*{fe}')
-        if not files:
-            # At least one of the BLAST db files is not existent
-            return False
-    return True
+    file_extensions = ('nhr', 'nin', 'nsq')
+    if all(os.path.exists(f'{db_path}.{fe}') for fe in file_extensions):
+        return True
+    # BLAST db might be split into multiple volumes (e.g. db.00.nhr)
+    db_dir, db_name = os.path.split(db_path)
+    try:
+        with os.scandir(db_dir or '.') as entries:
+            files = [entry.name for entry in entries if entry.name.startswith(db_name)]
+    except FileNotFoundError:
+        return False
+    # At least one of the BLAST db files has to exist for every extension
+    return all(any(f.endswith(f'.{fe}') for f in files) for fe in file_extensions)
 
 def make_blastndb(inpath, outpath):
-    db_command = 'makeblastdb -in {} -out {} -dbtype nucl'.format(inpath, outpath)
-    sp.call(db_command, shell=True)
+    # no -parse_seqids: sseqid has to match the FASTA headers used by pyfaidx and the miRNA input
+    db_command = ['makeblastdb', '-in', inpath, '-out', outpath, '-dbtype', 'nucl']
+    sp.run(db_command, check=True)
@@ -38,6 +38,9 @@ setup(
         'biopython',
         'pyfaidx'
     ],
+    extras_require={
+        'pyinfernal': ['pyinfernal']
+    },
     entry_points={
         'console_scripts': ["ncCreate = ncOrtho.coreset.coreset:main",
                             "ncSearch = ncOrtho.ncortho:main",